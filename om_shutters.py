@@ -4,20 +4,59 @@ import requests
 import logging
 import logging.handlers
 import os
-import pytz
+import signal
 import sys
+import threading
 import time
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from zoneinfo import ZoneInfo
 
 from sdk import OpenMoticsApi
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
-SUNRISE_URL = "http://api.sunrise-sunset.org/json?lat={0}&lng={1}&date={2}&formatted=0"
+SUNRISE_HOST = "http://api.sunrise-sunset.org"
+SUNRISE_URL = SUNRISE_HOST + "/json?lat={0}&lng={1}&date={2}&formatted=0"
 CFG_FILE = os.path.join(dir_path, "config.json")
 HISTORY_FILE = os.path.join(dir_path, "history.json")
 LOG_FILE = os.path.join(dir_path, "openmotics.log")
 SLEEP_BETWEEN_SHUTTERS = 3
+SUN_CACHE_PREFIX = "_sun_"
+SUNRISE_TIMEOUT = (3, 5)
+# Sun times of a previous day are reused as long as we're not close to sunrise or sunset
+SUN_CACHE_MAX_AGE = timedelta(days=7)
+SUN_CACHE_MARGIN = timedelta(hours=1)
+# When the sunrise API is down, only fall back to sun times of the last couple of days
+SUN_FALLBACK_MAX_AGE = timedelta(days=2)
+LOCAL_TZ = ZoneInfo("Europe/Brussels")
+
+
+class Shutter(object):
+    """ Configuration of the shutter in a single room. """
+    __slots__ = ('up', 'down', 'auto_up', 'auto_down', 'earliest_up', 'latest_down', 'up_key', 'down_key')
+
+    def __init__(self, up, down, auto_up, auto_down, earliest_up, latest_down):
+        self.up = up
+        self.down = down
+        self.auto_up = auto_up
+        self.auto_down = auto_down
+        self.earliest_up = earliest_up
+        self.latest_down = latest_down
+        # The outputs as used in history.json
+        self.up_key = str(up)
+        self.down_key = str(down)
+
+
+@lru_cache(maxsize=32)
+def _local_to_utc(date, hour, minute):
+    """ Convert a local hour:minute on the given date to a naive UTC datetime. """
+    dt = datetime(date.year, date.month, date.day, hour, minute, tzinfo=LOCAL_TZ)
+    dt_utc = dt.astimezone(timezone.utc)
+    return dt_utc.replace(tzinfo=None)
 
 
 class OpenMoticsShutter(object):
@@ -36,10 +75,12 @@ class OpenMoticsShutter(object):
         self.shutters = {}
 
         self._load_cfg()
+        self._load_history()
 
         self._setup_logging()
 
-        self.api = OpenMoticsApi(self.username, self.password, self.om_host, False)
+        self.session = self._create_session()
+        self.api = OpenMoticsApi(self.username, self.password, self.om_host, False, session=self.session)
 
     def _load_cfg(self):
         with open(CFG_FILE, 'r') as fh:
@@ -57,7 +98,35 @@ class OpenMoticsShutter(object):
         self.latitude = int(location.get("latitude", "0"))
         self.longitude = int(location.get("longitude", "0"))
 
-        self.shutters = cfg.get("shutters", {})
+        self.shutters = {room: Shutter(*values) for room, values in cfg.get("shutters", {}).items()}
+
+    def _load_history(self):
+        with open(HISTORY_FILE, 'r') as fh:
+            self._history = json.load(fh)
+        self._history_dirty = False
+
+    def _flush_history(self):
+        if not self._history_dirty:
+            return
+        # Write to a temporary file first so a crash never leaves a truncated history behind
+        tmp_file = HISTORY_FILE + ".tmp"
+        with open(tmp_file, 'w') as fh:
+            json.dump(self._history, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_file, HISTORY_FILE)
+        self._history_dirty = False
+
+    @staticmethod
+    def _create_session():
+        # Reuse connections for the sunrise API and the gateway
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=Retry(total=2, backoff_factor=0.3))
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        # Retries would stretch a failing sunrise fetch far beyond its timeout, we fall back to the cache instead
+        session.mount(SUNRISE_HOST, HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
+        return session
 
     def _setup_logging(self):
         # Setup logging
@@ -81,150 +150,226 @@ class OpenMoticsShutter(object):
     def _read_date(date):
         if date is None:
             return None
-        return datetime.strptime(date, '%Y-%m-%dT%H:%M:%S+00:00')
+        # Both the sunrise API and _write_date use this fixed layout, slicing it is cheaper than parsing
+        if len(date) == 25 and date.endswith('+00:00'):
+            return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                            int(date[11:13]), int(date[14:16]), int(date[17:19]))
+        # Dates are compared as naive UTC; convert any other offset before dropping it
+        dt = datetime.fromisoformat(date)
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+        return dt
 
     @staticmethod
     def _write_date(date):
-        return date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
-
-    def _check_history(self, output, date):
-        with open(HISTORY_FILE, 'r') as content:
-            history = json.load(content)
-            last_set = history.get(str(output), None)
-            self.logger.debug("Output [{}] was set on: {}".format(output, last_set))
-            last_set = self._read_date(last_set)
-        return last_set is None or date > last_set + timedelta(hours=15)
+        return date.isoformat(timespec='seconds') + '+00:00'
 
-    def _add_history(self, output, date):
-        with open(HISTORY_FILE, 'r') as content:
-            history = json.load(content)
-            history[str(output)] = date
-            self.logger.debug("Logging Output [{}] on: {}".format(output, date))
+    def _check_history(self, history_key, date):
+        last_set = self._history.get(history_key, None)
+        self.logger.debug("Output [%s] was set on: %s", history_key, last_set)
+        last_set = self._read_date(last_set)
+        return last_set is None or date > last_set + timedelta(hours=15)
 
-        with open(HISTORY_FILE, 'w+') as fh:
-            json.dump(history, fh)
+    def _add_history(self, history_key, date):
+        self._history[history_key] = date
+        self._history_dirty = True
+        self.logger.debug("Logging Output [%s] on: %s", history_key, date)
 
-    def _trigger_blinds(self, room, output):
-        self.logger.info("Triggering blind with output [{}] in room: [{}]".format(output, room))
-        local_now = datetime.now()
-        if not self._check_history(output, local_now):
+    def _get_cached_sun_times(self, local_now_dt, max_age=None):
+        """ Return the most recently cached sunrise and sunset, moved to today. Returns None if nothing is cached. """
+        for key, sun_times in self._history.items():
+            if not key.startswith(SUN_CACHE_PREFIX):
+                continue
+            cached_date = datetime.fromisoformat(key[len(SUN_CACHE_PREFIX):]).date()
+            delta = local_now_dt.date() - cached_date
+            if max_age is not None and delta > max_age:
+                return None
+            return self._read_date(sun_times["sunrise"]) + delta, self._read_date(sun_times["sunset"]) + delta
+        return None
+
+    def _get_sun_times(self, local_now_dt):
+        """ Return the sunrise and sunset for today, only hitting the API once per day. """
+        today = local_now_dt.strftime('%Y-%m-%d')
+        cache_key = SUN_CACHE_PREFIX + today
+        sun_times = self._history.get(cache_key)
+        if sun_times is not None:
+            self.logger.debug("Using cached sunrise/sunset for %s", today)
+            return self._read_date(sun_times["sunrise"]), self._read_date(sun_times["sunset"])
+
+        cached_sun_times = self._get_cached_sun_times(local_now_dt, max_age=SUN_CACHE_MAX_AGE)
+        if cached_sun_times is not None and all(abs(local_now_dt - dt) > SUN_CACHE_MARGIN for dt in cached_sun_times):
+            self.logger.debug("Not close to sunrise or sunset, using the last cached values")
+            return cached_sun_times
+
+        url = SUNRISE_URL.format(self.latitude, self.longitude, today)
+        try:
+            response = self.session.get(url, timeout=SUNRISE_TIMEOUT)
+            response.raise_for_status()
+            data = response.json()
+            if data.get("status") != "OK":
+                raise ValueError(f"Sunrise API returned status {data.get('status')}")
+            sun_times = {
+                "sunrise": data['results']['civil_twilight_begin'],
+                "sunset": data['results']['sunset'],
+            }
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            # Sunrise and sunset barely move from one day to the next, so a stale value beats hanging
+            cached_sun_times = self._get_cached_sun_times(local_now_dt, max_age=SUN_FALLBACK_MAX_AGE)
+            if cached_sun_times is None:
+                raise
+            self.logger.exception("Unable to fetch sunrise/sunset, using the last cached values")
+            return cached_sun_times
+
+        # Only keep the most recent day around
+        for key in [key for key in self._history if key.startswith(SUN_CACHE_PREFIX)]:
+            del self._history[key]
+        self._history[cache_key] = sun_times
+        self._history_dirty = True
+        return self._read_date(sun_times["sunrise"]), self._read_date(sun_times["sunset"])
+
+    def _should_trigger(self, room, output, history_key, local_now):
+        self.logger.info("Triggering blind with output [%s] in room: [%s]", output, room)
+        if not self._check_history(history_key, local_now):
             self.logger.info("Blind was already triggered")
             return False
         elif self.dry_run is not False:
             self.logger.warning("DRY RUN; not doing anything")
             return False
-        else:
-            self.api.set_output(output, True)
-            self._add_history(output, self._write_date(local_now))
+        return True
+
+    def _set_output(self, output, delay, stop):
+        """ Set the output after the delay. Returns False if stopped before the output was set. """
+        if stop.wait(delay):
+            return False
+        self.api.set_output(output, True)
         return True
 
     def _trigger_all_blinds(self, blinds):
-        for room, output in blinds:
-            if self._trigger_blinds(room, output):
-                self.logger.debug("Blind was triggered, sleeping for {} seconds...\n".format(SLEEP_BETWEEN_SHUTTERS))
-                time.sleep(SLEEP_BETWEEN_SHUTTERS)
+        local_now = datetime.now()
+        blinds = [blind for blind in blinds if self._should_trigger(*blind, local_now)]
+        if not blinds:
+            return
+
+        # Log in up front, otherwise slow workers could each log in and fire their relays together
+        if self.api.token is None:
+            self.api.login()
+
+        # Stagger the relays, but let the HTTP round-trips overlap with the delay between shutters
+        self.logger.debug("Triggering %s blinds, %s seconds apart...", len(blinds), SLEEP_BETWEEN_SHUTTERS)
+        stop = threading.Event()
+        futures = []
+        executor = ThreadPoolExecutor(max_workers=len(blinds))
+        try:
+            for i, (room, output, history_key) in enumerate(blinds):
+                future = executor.submit(self._set_output, output, i * SLEEP_BETWEEN_SHUTTERS, stop)
+                futures.append((room, output, history_key, future))
+            executor.shutdown(wait=True)
+        finally:
+            # When interrupted, skip the blinds still waiting and let the ones being set finish,
+            # so the history matches the relays that actually moved
+            stop.set()
+            executor.shutdown(wait=True)
+            for room, output, history_key, future in futures:
+                if future.exception() is not None:
+                    self.logger.error("Unable to trigger blind with output [%s] in room: [%s]", output, room,
+                                      exc_info=future.exception())
+                elif future.result():
+                    self._add_history(history_key, self._write_date(local_now))
+                else:
+                    self.logger.warning("Skipped blind with output [%s] in room: [%s]", output, room)
 
     def _parse_hour_minute(self, local_now_dt, value):
         if not value:
             return None
         try:
-            tz = pytz.timezone("Europe/Brussels")
-
             hour, minute = [int(val) for val in value.split(":", 1)]
-            dt = datetime(local_now_dt.year, local_now_dt.month, local_now_dt.day, hour, minute)
-            dt_localized = tz.localize(dt)
-            dt_utc = dt_localized.astimezone(pytz.utc)
-            self.logger.debug("{} was parsed as {}".format(value, dt_utc))
-            return dt_utc.replace(tzinfo=None)
+            dt_utc = _local_to_utc(local_now_dt.date(), hour, minute)
+            self.logger.debug("%s was parsed as %s", value, dt_utc)
+            return dt_utc
         except ValueError:
-            self.logger.exception("Unable to parse {} as \"hour:minute\"".format(value))
+            self.logger.exception('Unable to parse %s as "hour:minute"', value)
             return None
 
-    def _find_blinds_to_rise(self, sunrise_dt, local_now_dt, blinds_to_shut):
-        """ Return a list of blinds to automatically rise. Returns an empty list of nothing needs to be done."""
+    def _classify_blinds(self, sunrise_dt, sunset_dt, local_now_dt):
+        """ Return a tuple of (blinds to rise, blinds to shut) in a single pass. Either can be an empty list. """
         blinds_to_rise = []
-        rooms_shut = [room for (room, _) in blinds_to_shut]
+        blinds_to_shut = []
 
         is_sunrise = sunrise_dt <= local_now_dt
+        is_sunset = sunset_dt <= local_now_dt
         if not is_sunrise:
-            self.logger.debug("Sun hasn't risen yet. Skipping...")
-            return blinds_to_rise
-
-        for room, (up, down, auto_up, auto_down, earliest_up, latest_down) in self.shutters.iteritems():
-            if room in rooms_shut:
-                self.logger.debug("Shutter in room [{}] was just shut, not rising.".format(room))
+            self.logger.debug("Sun hasn't risen yet.")
+
+        for room, shutter in self.shutters.items():
+            self.logger.debug("Checking if shutter in room [%s] needs to be shut", room)
+            if not shutter.auto_down:
+                self.logger.debug("[%s] - auto-down is disabled.", room)
+            else:
+                latest_down_dt = self._parse_hour_minute(local_now_dt, shutter.latest_down)
+                if latest_down_dt is not None and latest_down_dt < local_now_dt:
+                    self.logger.info("[%s] - Should be shut on %s.", room, latest_down_dt)
+                    blinds_to_shut.append((room, shutter.down, shutter.down_key))
+                    continue
+                if is_sunset:
+                    self.logger.info("[%s] - Should be shut", room)
+                    blinds_to_shut.append((room, shutter.down, shutter.down_key))
+                    continue
+                self.logger.debug("Sun hasn't set yet.")
+
+            if not is_sunrise:
                 continue
-            self.logger.debug("Checking if shutter in room [{}] needs to be raised".format(room))
-            if not auto_up:
-                self.logger.debug("[{}] - auto-up is disabled. Skipping...".format(room))
+            self.logger.debug("Checking if shutter in room [%s] needs to be raised", room)
+            if not shutter.auto_up:
+                self.logger.debug("[%s] - auto-up is disabled. Skipping...", room)
                 continue
-            earliest_up_dt = self._parse_hour_minute(local_now_dt, earliest_up)
+            earliest_up_dt = self._parse_hour_minute(local_now_dt, shutter.earliest_up)
             if earliest_up_dt is not None and earliest_up_dt > local_now_dt:
-                self.logger.debug("[{}] - Should only be raised on {}. Skipping...".format(room, earliest_up_dt))
+                self.logger.debug("[%s] - Should only be raised on %s. Skipping...", room, earliest_up_dt)
                 continue
-            self.logger.info("[{}] - Should be raised".format(room))
-            blinds_to_rise.append((room, up))
-        return blinds_to_rise
-
-    def _find_blinds_to_shut(self, sunset_dt, local_now_dt):
-        """ Return a list of blinds to automatically rise. Returns an empty list of nothing needs to be done."""
-        blinds_to_shut = []
-
-        is_sunset = sunset_dt <= local_now_dt
-
-        for room, (up, down, auto_up, auto_down, earliest_up, latest_down) in self.shutters.iteritems():
-            self.logger.debug("Checking if shutter in room [{}] needs to be shut".format(room))
-            if not auto_down:
-                self.logger.debug("[{}] - auto-down is disabled. Skipping...".format(room))
-                continue
-            latest_down_dt = self._parse_hour_minute(local_now_dt, latest_down)
-            if latest_down_dt is not None and latest_down_dt < local_now_dt:
-                self.logger.info("[{}] - Should be shut on {}.".format(room, latest_down_dt))
-                blinds_to_shut.append((room, down))
-                continue
-            if not is_sunset:
-                self.logger.debug("Sun hasn't set yet. Skipping...")
-                continue
-            self.logger.info("[{}] - Should be shut".format(room))
-            blinds_to_shut.append((room, down))
-        return blinds_to_shut
+            self.logger.info("[%s] - Should be raised", room)
+            blinds_to_rise.append((room, shutter.up, shutter.up_key))
+        return blinds_to_rise, blinds_to_shut
 
     def run(self):
-        local_now_dt = datetime.now()
-        url = SUNRISE_URL.format(self.latitude, self.longitude, local_now_dt.strftime('%Y-%m-%d'))
-        data = requests.get(url).json()
-
-        sunrise = data['results']['civil_twilight_begin']
-        sunset = data['results']['sunset']
-        sunrise_dt = self._read_date(sunrise)
-        sunset_dt = self._read_date(sunset)
-
-        self.logger.info("Local time: {}".format(local_now_dt))
-        self.logger.info("Sunrise: {}".format(sunrise_dt))
-        self.logger.info("Sunset {}".format(sunset_dt))
-
-        blinds_to_shut = self._find_blinds_to_shut(sunset_dt, local_now_dt)
-        if blinds_to_shut:
-            self.logger.debug("Blinds to shut: {}".format(blinds_to_shut))
-            self.logger.info("Shutting blinds: {}".format([blind[0] for blind in blinds_to_shut]))
-            self._trigger_all_blinds(blinds_to_shut)
-        else:
-            self.logger.debug("Nothing to shut")
-
-
-        blinds_to_rise = self._find_blinds_to_rise(sunrise_dt, local_now_dt, blinds_to_shut)
-        if blinds_to_rise:
-            self.logger.debug("Blinds to rise: {}".format(blinds_to_rise))
-            self.logger.info("Rising blinds: {}".format([blind[0] for blind in blinds_to_rise]))
-            self._trigger_all_blinds(blinds_to_rise)
-        else:
-            self.logger.debug("Nothing to rise")
-
-        if not blinds_to_rise and not blinds_to_shut:
-            self.logger.info("Nothing to do")
+        if not any(shutter.auto_up or shutter.auto_down for shutter in self.shutters.values()):
+            self.logger.info("Nothing configured to rise or shut automatically")
+            return
+
+        try:
+            local_now_dt = datetime.now()
+            sunrise_dt, sunset_dt = self._get_sun_times(local_now_dt)
+
+            self.logger.info("Local time: %s", local_now_dt)
+            self.logger.info("Sunrise: %s", sunrise_dt)
+            self.logger.info("Sunset %s", sunset_dt)
+
+            blinds_to_rise, blinds_to_shut = self._classify_blinds(sunrise_dt, sunset_dt, local_now_dt)
+            if blinds_to_shut:
+                self.logger.debug("Blinds to shut: %s", blinds_to_shut)
+                if self.logger.isEnabledFor(logging.INFO):
+                    self.logger.info("Shutting blinds: %s", [blind[0] for blind in blinds_to_shut])
+                self._trigger_all_blinds(blinds_to_shut)
+            else:
+                self.logger.debug("Nothing to shut")
+
+            if blinds_to_rise:
+                self.logger.debug("Blinds to rise: %s", blinds_to_rise)
+                if self.logger.isEnabledFor(logging.INFO):
+                    self.logger.info("Rising blinds: %s", [blind[0] for blind in blinds_to_rise])
+                self._trigger_all_blinds(blinds_to_rise)
+            else:
+                self.logger.debug("Nothing to rise")
+
+            if not blinds_to_rise and not blinds_to_shut:
+                self.logger.info("Nothing to do")
+        finally:
+            # Also save what was triggered so far when the run is interrupted
+            self._flush_history()
         self.logger.info("Finished")
 
 
 if __name__ == '__main__':
+    # Turn SIGTERM into SystemExit so the history still gets flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
     oms = OpenMoticsShutter()
     oms.run()
@@ -1,4 +1,4 @@
-## Depends on 2.7 and requests (http://www.python-requests.org/)
+## Depends on Python 3.9+ and requests (http://www.python-requests.org/)
 
 import json
 import requests
@@ -45,16 +45,18 @@ class ApiException(Exception):
 class OpenMoticsApi:
     """ Connector for the OpenMotics Gateway API. """
 
-    def __init__(self, username, password, hostname, verify_https=False, port=443):
+    def __init__(self, username, password, hostname, verify_https=False, port=443, session=None):
         """
         Create a new connector. This constructor requires the gateway username and password.
         These credentials are not the same as the username and password on the OpenMotics cloud.
+        An existing requests.Session can be passed to share its connection pool.
         """
         self.auth = { "username" : username, "password" : password }
         self.hostname = hostname
         self.verify_https = verify_https
         self.port = port
         self.token = None
+        self.session = session if session is not None else requests.Session()
 
     def get_url(self, action):
         """ Get the url for an action. """
@@ -72,7 +74,7 @@ class OpenMoticsApi:
         url = self.get_url(action)
         post_data = self.get_post_data(post_data)
         
-        r = requests.post(url, params=get_params, data=post_data, verify=self.verify_https)
+        r = self.session.post(url, params=get_params, data=post_data, verify=self.verify_https)
         if r.status_code == 401:
             self.token = None
             raise AuthenticationException()